@@ -10,16 +10,31 @@ Chức năng chính:
 """
 
 import asyncio
-import base64
 import os
 import secrets
 import struct
 import threading
+import logging
 import sys
-print(f"� Starting App with Python version: {sys.version}")
-from flask import Flask, render_template, request, jsonify, Response, session, redirect, url_for, flash
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# Logging: mức log đọc 1 lần từ biến môi trường LOGLEVEL (mặc định WARNING)
+logging.basicConfig(format="%(asctime)s %(levelname)s [%(name)s] %(message)s")
+log = logging.getLogger('chatbot')
+_log_level = logging.getLevelName(os.getenv('LOGLEVEL', 'WARNING').upper())
+log.setLevel(_log_level if isinstance(_log_level, int) else logging.WARNING) # LOGLEVEL sai -> WARNING
+log.info("Starting App with Python version: %s", sys.version)
+
+from flask import Flask, render_template, request, jsonify, Response, session, redirect, url_for, flash, abort
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from flask_compress import Compress
 from dotenv import load_dotenv
+from bson.objectid import ObjectId
+
+# JSON nhanh: orjson (voice_service cũng dùng orjson cho frame WebSocket)
+import orjson
 
 # Import các service đã tách
 from text_service import TextChatService
@@ -29,13 +44,42 @@ from db_utils import DatabaseManager
 # Load biến môi trường
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 if os.path.exists(dotenv_path):
-    print(f"Loading .env from {dotenv_path}")
+    log.info("Loading .env from %s", dotenv_path)
     load_dotenv(dotenv_path)
 else:
-    print("⚠️ .env file not found!")
+    log.warning("⚠️ .env file not found!")
+
+def _orjson_default(obj):
+    """Serialize các kiểu orjson không hỗ trợ sẵn (ObjectId từ MongoDB, ...)."""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    return str(obj)
+
+class OrJSONProvider(JSONProvider):
+    """JSON provider dùng orjson thay cho json của stdlib (nhanh hơn nhiều với payload lớn)."""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS, default=_orjson_default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
-app.secret_key = secrets.token_hex(16) # Secret key cho session
+app.json = OrJSONProvider(app)
+# Secret key cho session: đọc từ env để cookie còn hiệu lực sau khi restart
+# và dùng chung giữa các gunicorn worker. Fallback key ngẫu nhiên khi dev.
+app.secret_key = os.environ.get('FLASK_SECRET_KEY') or secrets.token_hex(16)
+
+# Session cookie chỉ gửi qua HTTPS khi deploy (gunicorn / Vercel đứng sau TLS).
+# Chạy `python app.py` (HTTP trên LAN) thì mặc định tắt, xem khối __main__.
+app.config['SESSION_COOKIE_SECURE'] = os.environ.get('SESSION_COOKIE_SECURE', '1') != '0'
+
+# Nén HTTP (Brotli/Gzip) cho response JSON/HTML lớn như lịch sử chat.
+# Reply voice (multipart/form-data, chứa WAV) không nằm trong COMPRESS_MIMETYPES mặc định nên không bị nén.
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 500
+Compress(app)
 
 # Enable CORS for Flutter web app (Allow all for development)
 CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
@@ -46,23 +90,71 @@ if not GOOGLE_API_KEY:
     raise ValueError("Vui lòng đặt GOOGLE_API_KEY (hoặc GEMINI_API_KEY) trong file .env")
 
 # Khởi tạo Services
+# Khởi tạo song song để thời gian cold start = service chậm nhất, không phải tổng
 try:
-    voice_service = VoiceChatService(GOOGLE_API_KEY)
-    text_service = TextChatService(GOOGLE_API_KEY) # Khởi tạo Text Service
-    db_manager = DatabaseManager() # Khởi tạo DB
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        voice_future = executor.submit(VoiceChatService, GOOGLE_API_KEY)
+        text_future = executor.submit(TextChatService, GOOGLE_API_KEY) # Khởi tạo Text Service
+        db_future = executor.submit(DatabaseManager) # Khởi tạo DB
+        voice_service = voice_future.result()
+        text_service = text_future.result()
+        db_manager = db_future.result()
     
     # Gán DB Manager cho Text Service để nó có thể lưu tin nhắn
     text_service.db_manager = db_manager 
     
-    print("✅ Services initialized successfully!")
+    log.info("✅ Services initialized successfully!")
 except Exception as e:
-    print(f"❌ Error initializing services: {e}")
+    log.error("❌ Error initializing services: %s", e)
     voice_service = None
     text_service = None
     db_manager = None
 
+# Event loop asyncio dùng chung cho Voice Service, chạy trên 1 thread nền.
+# Tránh tạo/đóng event loop mới cho mỗi request voice.
+def _start_background_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="aio-loop", daemon=True).start()
+    return loop
+
+app.config['AIO_LOOP'] = _start_background_loop()
+
+# Mở sẵn Gemini session cho cấu hình mặc định của /api/chat (Charon, vi).
+# Opt-in (VOICE_WARMUP=1): mỗi process giữ session mở và tốn quota Live API.
+# Không bao giờ bật trên Vercel: process bị đóng băng giữa các lần gọi -> session trong pool bị cũ.
+if voice_service and os.getenv('VOICE_WARMUP') == '1' and not os.getenv('VERCEL'):
+    asyncio.run_coroutine_threadsafe(voice_service.warmup('Charon', 'vi'), app.config['AIO_LOOP'])
+
 # --- AUTH ROUTES ---
 
+def read_json_body(required=True):
+    """
+    Parse JSON body trực tiếp từ bytes (orjson), bỏ qua bước kiểm tra
+    content-type và cache body của request.get_json().
+    Body rỗng: lỗi 400 nếu required, ngược lại trả về None.
+    """
+    raw = request.get_data(cache=False)
+    if not raw:
+        if not required:
+            return None
+        abort(400, description="Missing JSON body")
+    try:
+        return orjson.loads(raw)
+    except ValueError:
+        abort(400, description="Invalid JSON body")
+
+def get_user_id():
+    """
+    Lấy user_id của request.
+    Ưu tiên Authorization header (Flutter): khi có token thì không đọc session,
+    tránh phải verify chữ ký cookie trên mỗi API call.
+    """
+    # For now, the token is the user_id itself
+    # TODO: Implement proper JWT token validation
+    auth = request.headers.get('Authorization')
+    user_id = auth.removeprefix('Bearer ').strip() if auth else None
+    return user_id or session.get('user_id')
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -90,16 +182,8 @@ def login():
 
 @app.route('/api/conversations/<conversation_id>', methods=['GET'])
 def get_conversation_messages(conversation_id):
-    # Support both session cookie and Authorization header
-    user_id = None
-    
-    # Check session first
-    if 'user_id' in session:
-        user_id = session['user_id']
-    # Check Authorization header (for Flutter web)
-    elif 'Authorization' in request.headers:
-        token = request.headers.get('Authorization').replace('Bearer ', '')
-        user_id = token
+    # Support both Authorization header and session cookie
+    user_id = get_user_id()
     
     if not user_id:
         return jsonify({"error": "Unauthorized"}), 401
@@ -123,16 +207,12 @@ def register():
 @app.route('/api/change-password', methods=['POST'])
 def change_password():
     # Support Token
-    user_id = None
-    if 'user_id' in session:
-        user_id = session['user_id']
-    elif 'Authorization' in request.headers:
-        user_id = request.headers.get('Authorization').replace('Bearer ', '')
+    user_id = get_user_id()
     
     if not user_id:
         return jsonify({"success": False, "error": "Unauthorized"}), 401
         
-    data = request.get_json()
+    data = read_json_body()
     old_password = data.get('old_password')
     new_password = data.get('new_password')
     
@@ -176,19 +256,9 @@ def chat_text(conversation_id=None):
 
 @app.route('/api/conversations', methods=['GET'])
 def get_conversations():
-    print("🔔 [API] Hit /api/conversations (GET)", flush=True)
-    # Support both session cookie and Authorization header
-    user_id = None
-    
-    # Check session first
-    if 'user_id' in session:
-        user_id = session['user_id']
-    # Check Authorization header (for Flutter web)
-    elif 'Authorization' in request.headers:
-        token = request.headers.get('Authorization').replace('Bearer ', '')
-        # For now, use username as token (simple approach)
-        # TODO: Implement proper JWT token validation
-        user_id = token
+    log.debug("🔔 [API] Hit /api/conversations (GET)")
+    # Support both Authorization header and session cookie
+    user_id = get_user_id()
     
     if not user_id:
         return jsonify({"error": "Unauthorized"}), 401
@@ -199,15 +269,11 @@ def get_conversations():
 @app.route('/api/conversations', methods=['POST'])
 def create_conversation():
     # Support Token
-    user_id = None
-    if 'user_id' in session:
-        user_id = session['user_id']
-    elif 'Authorization' in request.headers:
-        user_id = request.headers.get('Authorization').replace('Bearer ', '')
+    user_id = get_user_id()
     
     if not user_id: return jsonify({"error": "Unauthorized"}), 401
     
-    data = request.get_json() or {}
+    data = read_json_body(required=False) or {}
     title = data.get('title', 'Chat mới')
     
     conv_id = db_manager.create_conversation(user_id, title)
@@ -216,11 +282,7 @@ def create_conversation():
 @app.route('/api/conversations/<conversation_id>', methods=['DELETE'])
 def delete_conversation(conversation_id):
     # Support Token
-    user_id = None
-    if 'user_id' in session:
-        user_id = session['user_id']
-    elif 'Authorization' in request.headers:
-        user_id = request.headers.get('Authorization').replace('Bearer ', '')
+    user_id = get_user_id()
     
     if not user_id:
         return jsonify({"error": "Unauthorized"}), 401
@@ -230,17 +292,9 @@ def delete_conversation(conversation_id):
 
 @app.route('/api/history', methods=['GET'])
 def get_chat_history():
-    print("🔔 [API] Hit /api/history (GET)", flush=True)
-    # Support both session cookie and Authorization header
-    user_id = None
-    
-    # Check session first
-    if 'user_id' in session:
-        user_id = session['user_id']
-    # Check Authorization header (for Flutter/Mobile)
-    elif 'Authorization' in request.headers:
-        token = request.headers.get('Authorization').replace('Bearer ', '')
-        user_id = token
+    log.debug("🔔 [API] Hit /api/history (GET)")
+    # Support both Authorization header (Flutter/Mobile) and session cookie
+    user_id = get_user_id()
         
     if not user_id:
         return jsonify({"history": []})
@@ -268,13 +322,13 @@ def get_chat_history():
 
 @app.route('/api/chat-text', methods=['POST'])
 def chat_text_api():
-    print("🔔 [API] Hit /api/chat-text (POST)", flush=True)
+    log.debug("🔔 [API] Hit /api/chat-text (POST)")
     # Allow usage without login (just won't save history)
     
     if not text_service:
         return jsonify({"error": "Service not initialized"}), 500
     
-    data = request.get_json()
+    data = read_json_body()
     message = data.get('message', '')
     conversation_history = data.get('history', [])
     system_prompt = data.get('system_prompt', '')
@@ -295,43 +349,65 @@ def chat_text_api():
         return jsonify({"success": True, "text": response_text})
         
     except Exception as e:
-        print(f"Chat Error: {e}")
+        log.error("Chat Error: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
-def add_wav_header(pcm_data, sample_rate=24000, channels=1, bits_per_sample=16):
-    """Adds a WAV header to raw PCM data."""
+# Header WAV cố định cho output của Gemini (24kHz, mono, 16-bit PCM).
+# Chỉ 2 trường độ dài (offset 4 và 40) thay đổi theo dữ liệu.
+_WAV_HEADER_TEMPLATE = bytearray(struct.pack('<4sI4s4sIHHIIHH4sI',
+    b'RIFF',
+    0,               # 36 + data_size (patched per call)
+    b'WAVE',
+    b'fmt ',
+    16,              # PCM chunk size
+    1,               # Audio format (1 = PCM)
+    1,               # Channels
+    24000,           # Sample rate
+    48000,           # Byte rate = sample_rate * channels * 2
+    2,               # Block align
+    16,              # Bits per sample
+    b'data',
+    0                # data_size (patched per call)
+))
+
+def add_wav_header(pcm_data):
+    """Adds a WAV header (24kHz, mono, 16-bit) to raw PCM data."""
     data_size = len(pcm_data)
-    byte_rate = sample_rate * channels * (bits_per_sample // 8)
-    block_align = channels * (bits_per_sample // 8)
-    
-    header = struct.pack('<4sI4s4sIHHIIHH4sI',
-        b'RIFF',
-        36 + data_size,
-        b'WAVE',
-        b'fmt ',
-        16,              # PCM chunk size
-        1,               # Audio format (1 = PCM)
-        channels,
-        sample_rate,
-        byte_rate,
-        block_align,
-        bits_per_sample,
-        b'data',
-        data_size
-    )
-    return header + pcm_data
+    header = bytearray(_WAV_HEADER_TEMPLATE)
+    header[4:8] = (36 + data_size).to_bytes(4, 'little')
+    header[40:44] = data_size.to_bytes(4, 'little')
+    return bytes(header) + pcm_data
+
+def multipart_voice_response(text, pcm_data):
+    """
+    Trả text + WAV nhị phân trong cùng 1 response multipart/form-data (không base64,
+    không cần lưu audio trên server -> chạy được cả trên serverless như Vercel).
+    Browser đọc bằng `await res.formData()`: field "text" và file "audio".
+    """
+    boundary = secrets.token_hex(16)
+    wav_audio = add_wav_header(pcm_data)
+    body = b''.join([
+        f'--{boundary}\r\nContent-Disposition: form-data; name="text"\r\n'
+        f'Content-Type: text/plain; charset=utf-8\r\n\r\n'.encode(),
+        text.encode('utf-8'),
+        f'\r\n--{boundary}\r\nContent-Disposition: form-data; name="audio"; filename="reply.wav"\r\n'
+        f'Content-Type: audio/wav\r\n\r\n'.encode(),
+        wav_audio,
+        f'\r\n--{boundary}--\r\n'.encode()
+    ])
+    return Response(body, content_type=f'multipart/form-data; boundary={boundary}', headers={'Content-Length': str(len(body))})
 
 @app.route('/api/chat', methods=['POST', 'OPTIONS'])
 def chat_voice_api():
-    print(f"\n🔔 [API] Hit /api/chat - Method: {request.method}", flush=True)
+    log.debug("🔔 [API] Hit /api/chat - Method: %s", request.method)
     if request.method == 'OPTIONS':
         return jsonify({"success": True}), 200
         
     if not voice_service:
         return jsonify({"error": "Service not initialized"}), 500
     
-    data = request.get_json()
+    data = read_json_body()
     message = data.get('message', '')
     voice = data.get('voice', 'Charon')
     language = data.get('language', 'vi') # Default Vietnamese
@@ -340,29 +416,68 @@ def chat_voice_api():
     mime_type = data.get('mime_type', 'audio/wav') # Default to WAV
 
     if audio_input:
-        print(f"🎤 App: Received Audio Input: {len(audio_input)} chars (Base64)")
+        log.debug("🎤 App: Received Audio Input: %d chars (Base64)", len(audio_input))
+    
+    return _voice_chat_response(message, voice, history, language, mime_type, audio_input=audio_input)
+
+@app.route('/api/chat/audio-upload', methods=['POST'])
+def chat_voice_upload_api():
+    """
+    Voice chat với audio gửi dạng nhị phân (body = audio/wav hoặc audio/webm).
+    Metadata nhỏ đi qua header: X-Voice, X-Language, X-Conversation-Id.
+    Không cần JSON parse + base64 decode cho khối audio lớn.
+    """
+    log.debug("🔔 [API] Hit /api/chat/audio-upload (POST)")
+    # Lịch sử đọc từ DB + lưu lại turn voice -> bắt buộc đăng nhập
+    user_id = get_user_id()
+    if not user_id:
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    if not voice_service:
+        return jsonify({"error": "Service not initialized"}), 500
+    
+    audio_bytes = request.get_data(cache=False)
+    if not audio_bytes:
+        return jsonify({"error": "No audio uploaded"}), 400
     
+    voice = request.headers.get('X-Voice', 'Charon')
+    language = request.headers.get('X-Language', 'vi')
+    conversation_id = request.headers.get('X-Conversation-Id')
+    mime_type = request.mimetype or 'audio/wav'
+    log.debug("🎤 App: Received Audio Upload: %d bytes (%s)", len(audio_bytes), mime_type)
+    
+    # Lịch sử (các tin mới nhất) lấy từ DB theo conversation_id thay vì gửi kèm trong body
+    history = []
+    if conversation_id:
+        if not db_manager or not db_manager.owns_conversation(conversation_id, user_id):
+            return jsonify({"error": "Conversation not found"}), 404
+        history = db_manager.get_recent_messages(conversation_id)
+    
+    return _voice_chat_response('', voice, history, language, mime_type, audio_bytes=audio_bytes, conversation_id=conversation_id)
+
+def _voice_chat_response(message, voice, history, language, mime_type, audio_input=None, audio_bytes=None, conversation_id=None):
+    """
+    Chạy voice chat trên event loop nền và trả multipart (text + audio WAV).
+    Có conversation_id thì lưu turn (msg_type="voice") để lần gọi sau có lịch sử.
+    """
     try:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(
-            voice_service.chat_with_voice(message, voice, history, language, audio_input, mime_type)
+        fut = asyncio.run_coroutine_threadsafe(
+            voice_service.chat_with_voice(message, voice, history, language, audio_input, mime_type, audio_bytes=audio_bytes),
+            app.config['AIO_LOOP']
         )
-        loop.close()
+        result = fut.result()
         
-        # Add WAV header to raw PCM
-        wav_audio = add_wav_header(result['audio'])
-        audio_b64 = base64.b64encode(wav_audio).decode('utf-8')
+        if conversation_id and db_manager:
+            # Audio không có transcript (Gemini không trả inputTranscription) -> placeholder
+            user_text = message or result.get('transcript') or "[Voice message]"
+            db_manager.save_messages_batch([
+                {"role": "user", "content": user_text, "msg_type": "voice"},
+                {"role": "model", "content": result['text'], "msg_type": "voice"}
+            ], conversation_id=conversation_id)
         
-        return jsonify({
-            "success": True, 
-            "text": result['text'], 
-            "audio": audio_b64,
-            "format": "wav",
-            "sample_rate": 24000
-        })
+        return multipart_voice_response(result['text'], result['audio'])
     except Exception as e:
-        print(f"Voice Error: {e}")
+        log.error("Voice Error: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
@@ -397,7 +512,7 @@ def ocr_api():
 def translate_api():
     # Allow usage without login
     
-    data = request.get_json()
+    data = read_json_body()
     text = data.get('text', '')
     source_lang = data.get('source', 'auto')
     target_lang = data.get('target', 'vi')
@@ -416,9 +531,12 @@ if __name__ == '__main__':
     # Chạy server trên tất cả IP (0.0.0.0) port 5000
     # ssl_context='adhoc' để enable HTTPS (tự tạo cert) -> Giúp micro hoạt động trên LAN
     # Tuy nhiên adhoc cần cài thêm thư viện (pyopenssl), nếu chưa có thì chạy HTTP thường
+    # Dev server phục vụ HTTP thường -> browser sẽ bỏ cookie Secure, trừ khi đặt rõ SESSION_COOKIE_SECURE=1
+    if 'SESSION_COOKIE_SECURE' not in os.environ:
+        app.config['SESSION_COOKIE_SECURE'] = False
     try:
         # Tắt reloader hoàn toàn để tránh lỗi select.select trên Windows
         # debug=True vẫn giữ lại debugger nhưng use_reloader=False ngăn chặn việc spawn tiến trình con
         app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False, threaded=True)
     except Exception as e:
-        print(f"Server error: {e}")
+        log.error("Server error: %s", e)
@@ -30,8 +30,16 @@ Chức năng chính:
 """
 
 import os
+import time
+import logging
+import hmac
+import hashlib
+import secrets
 import datetime
-from pymongo import MongoClient
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from pymongo import MongoClient, UpdateOne
 from pymongo.server_api import ServerApi
 from dotenv import load_dotenv
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -40,26 +48,120 @@ from bson.objectid import ObjectId
 load_dotenv()
 
 MONGODB_URI = os.getenv('MONGODB_URI', '')
+# Logger của app ("chatbot"): mức log cấu hình qua LOGLEVEL ở app.py.
+# Không tự in ra stdout khi chưa cấu hình handler (NullHandler).
+log = logging.getLogger('chatbot.db')
+logging.getLogger('chatbot').addHandler(logging.NullHandler())
+# Bật log debug riêng cho DB bằng biến môi trường DEBUG_DB=1
+if os.getenv('DEBUG_DB'):
+    log.setLevel(logging.DEBUG)
+# Khoảng thời gian tối thiểu (giây) giữa 2 lần ghi updated_at của cùng 1 conversation
+UPDATED_AT_DEBOUNCE_SEC = 5.0
+# Cache đăng nhập thành công để bỏ qua pbkdf2 khi client đăng nhập lại liên tục
+LOGIN_CACHE_TTL_SEC = 60.0
+LOGIN_CACHE_MAX_SIZE = 1024
+# Chỉ gửi N turn gần nhất cho model -> prompt không phình theo độ dài hội thoại
+MAX_HISTORY_TURNS = 20
+
+def recent_history(history, limit=MAX_HISTORY_TURNS):
+    """
+    Last `limit` turns of a chat history. When the window is cut, it starts
+    on a "user" turn so it never follows the fake-history / previous "model" turn.
+    """
+    if len(history) <= limit:
+        return history
+    window = history[-limit:]
+    start = 0
+    while start < len(window) and not (isinstance(window[start], dict) and window[start].get('role') == 'user'):
+        start += 1
+    return window[start:]
+
+@lru_cache(maxsize=4096)
+def _oid(id_str):
+    """ObjectId từ chuỗi, cache cho các conversation/user đang hoạt động"""
+    return ObjectId(id_str)
+
+_client = None
+_client_lock = threading.Lock()
+
+def _shared_client():
+    """MongoClient dùng chung cho mọi DatabaseManager trong process (1 connection pool)"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            # Pool cấu hình rõ ràng (vừa với Atlas M0/M2), giữ sẵn vài kết nối ấm.
+            # Nén wire protocol: zstd (cần package zstandard), fallback zlib có sẵn.
+            _client = MongoClient(
+                MONGODB_URI,
+                server_api=ServerApi('1'),
+                serverSelectionTimeoutMS=5000,
+                maxPoolSize=50,
+                minPoolSize=5,
+                maxIdleTimeMS=60000,
+                retryWrites=True,
+                compressors='zstd,zlib'
+            )
+        return _client
 
 class DatabaseManager:
+    # Index chỉ cần tạo 1 lần cho mỗi process (có nhiều instance DatabaseManager)
+    _indexes_ensured = False
+    _indexes_lock = threading.Lock()
+
     def __init__(self):
         self.db = None
         self.client = None
+        # Debounce cập nhật updated_at: conversation_id -> thời điểm ghi gần nhất (monotonic)
+        self._last_bump = {}
+        # Các updated_at chưa ghi xuống DB: conversation_id -> datetime
+        self._pending_bumps = {}
+        self._bump_lock = threading.Lock()
+        self._bump_flusher = None # Thread ghi các updated_at bị hoãn sau mỗi chu kỳ debounce
+        # Login cache: username -> (password_digest, user_id, expires_at)
+        # Chỉ lưu HMAC của mật khẩu với key ngẫu nhiên theo process, không lưu plaintext.
+        self._login_cache = OrderedDict()
+        self._login_cache_key = secrets.token_bytes(32)
+        self._login_lock = threading.Lock()
         self.connect()
 
     def connect(self):
         if not MONGODB_URI:
-            print("⚠️ MONGODB_URI not found in environment variables.")
+            log.warning("⚠️ MONGODB_URI not found in environment variables.")
             return
 
         try:
             # Connect without blocking ping
-            self.client = MongoClient(MONGODB_URI, server_api=ServerApi('1'), serverSelectionTimeoutMS=5000)
-            print("🔄 MongoDB client initialized (connection will be verified on first request)")
+            self.client = _shared_client()
+            log.info("🔄 MongoDB client initialized (connection will be verified on first request)")
             self.db = self.client['gemini_chat_db']
         except Exception as e:
-            print(f"❌ MongoDB connection failed: {e}")
+            log.error("❌ MongoDB connection failed: %s", e)
             self.db = None
+            return
+
+        self.ensure_indexes()
+
+    def ensure_indexes(self):
+        """Create indexes used by the hot queries (once per process, in a background thread)"""
+        with DatabaseManager._indexes_lock:
+            if self.db is None or DatabaseManager._indexes_ensured:
+                return
+            # Đặt cờ trước: lỗi / timeout không làm mọi instance sau phải chờ lại
+            DatabaseManager._indexes_ensured = True
+
+        # create_index là round-trip đồng bộ -> chạy nền để không chặn __init__
+        threading.Thread(target=self._create_indexes, name="mongo-indexes", daemon=True).start()
+
+    def _create_indexes(self):
+        try:
+            # get_user_conversations: filter user_id, sort updated_at desc
+            self.db['conversations'].create_index([("user_id", 1), ("updated_at", -1)])
+            # get_messages / get_conversation_messages: filter conversation_id, sort timestamp
+            self.db['messages'].create_index([("conversation_id", 1), ("timestamp", 1)])
+            # authenticate_user / register_user: lookup by username
+            self.db['users'].create_index("username", unique=True)
+        except Exception as e:
+            log.warning("⚠️ Could not create MongoDB indexes: %s", e)
 
     def create_conversation(self, user_id, title="New Chat"):
         """Create a new conversation"""
@@ -80,17 +182,27 @@ class DatabaseManager:
         if self.db is None:
             return []
         
-        conv_col = self.db['conversations']
-        cursor = conv_col.find({"user_id": user_id}).sort("updated_at", -1).limit(limit)
+        # Ghi các updated_at đang debounce để thứ tự sắp xếp chính xác
+        self.flush_pending_bumps()
         
-        conversations = []
-        for doc in cursor:
-            conversations.append({
-                "id": str(doc["_id"]),
-                "title": doc.get("title", "New Chat"),
-                "updated_at": doc["updated_at"].isoformat() if isinstance(doc.get("updated_at"), datetime.datetime) else str(doc.get("updated_at"))
-            })
-        return conversations
+        conv_col = self.db['conversations']
+        # Mongo trả về dict đúng format cho API (id/updated_at dạng string), không cần xử lý thêm ở Python
+        cursor = conv_col.aggregate([
+            {"$match": {"user_id": user_id}},
+            {"$sort": {"updated_at": -1}},
+            {"$limit": limit},
+            {"$project": {
+                "_id": 0,
+                "id": {"$toString": "$_id"},
+                "title": {"$ifNull": ["$title", "New Chat"]},
+                "updated_at": {"$cond": [
+                    {"$eq": [{"$type": "$updated_at"}, "date"]},
+                    {"$dateToString": {"format": "%Y-%m-%dT%H:%M:%S.%LZ", "date": "$updated_at"}},
+                    {"$toString": "$updated_at"}
+                ]}
+            }}
+        ])
+        return list(cursor)
 
     def delete_conversation(self, conversation_id, user_id):
         """Delete a conversation and all its messages"""
@@ -100,13 +212,13 @@ class DatabaseManager:
         try:
             # 1. Verify owner
             conv_col = self.db['conversations']
-            conv = conv_col.find_one({"_id": ObjectId(conversation_id), "user_id": user_id})
+            conv = conv_col.find_one({"_id": _oid(conversation_id), "user_id": user_id})
             
             if not conv:
                 return False # Not found or not owner
                 
             # 2. Delete conversation
-            conv_col.delete_one({"_id": ObjectId(conversation_id)})
+            conv_col.delete_one({"_id": _oid(conversation_id)})
             
             # 3. Delete messages
             msg_col = self.db['messages']
@@ -114,7 +226,7 @@ class DatabaseManager:
             
             return True
         except Exception as e:
-            print(f"❌ Error deleting conversation: {e}")
+            log.error("❌ Error deleting conversation: %s", e)
             return False
 
     def save_message(self, role, content, conversation_id, msg_type="text"):
@@ -123,6 +235,7 @@ class DatabaseManager:
             return None
         
         try:
+            now = datetime.datetime.utcnow()
             # 1. Save message
             msg_col = self.db['messages']
             msg_col.insert_one({
@@ -130,25 +243,105 @@ class DatabaseManager:
                 "role": role,
                 "content": content,
                 "msg_type": msg_type,
-                "timestamp": datetime.datetime.now()
+                "timestamp": now
             })
             
-            # 2. Update conversation timestamp and title (if first message)
-            conv_col = self.db['conversations']
-            update_data = {"updated_at": datetime.datetime.now()}
-            
-            # Update title based on user's first message if title is default
-            # (Simplified logic: just update time for now)
+            # 2. Update conversation timestamp (debounced)
+            self._bump_updated_at(conversation_id, now)
+            return True
+        except Exception as e:
+            log.error("❌ Error saving message: %s", e)
+            return None
+
+    def save_messages_batch(self, docs, conversation_id):
+        """Save several messages of one chat turn with a single insert_many.
+        docs: list of {"role", "content", "msg_type"(optional)}"""
+        if self.db is None or not docs:
+            return None
+        
+        try:
+            now = datetime.datetime.utcnow()
+            self.db['messages'].insert_many([
+                {
+                    "conversation_id": conversation_id,
+                    "role": doc["role"],
+                    "content": doc["content"],
+                    "msg_type": doc.get("msg_type", "text"),
+                    # BSON datetime chỉ chính xác tới millisecond -> lệch 1ms để giữ thứ tự khi sort theo timestamp
+                    "timestamp": now + datetime.timedelta(milliseconds=i)
+                }
+                for i, doc in enumerate(docs)
+            ], ordered=True)
             
-            conv_col.update_one(
-                {"_id": ObjectId(conversation_id)},
-                {"$set": update_data}
-            )
+            self._bump_updated_at(conversation_id, now)
             return True
         except Exception as e:
-            print(f"❌ Error saving message: {e}")
+            log.error("❌ Error saving messages: %s", e)
             return None
 
+    def _bump_updated_at(self, conversation_id, updated_at):
+        """Update conversation updated_at, at most once per UPDATED_AT_DEBOUNCE_SEC.
+        Skipped bumps are kept in memory and written by flush_pending_bumps()."""
+        mono_now = time.monotonic()
+        with self._bump_lock:
+            self._ensure_bump_flusher()
+            last = self._last_bump.get(conversation_id)
+            if last is not None and mono_now - last < UPDATED_AT_DEBOUNCE_SEC:
+                self._pending_bumps[conversation_id] = updated_at
+                return
+            self._last_bump[conversation_id] = mono_now
+            self._pending_bumps.pop(conversation_id, None)
+
+        self.db['conversations'].update_one(
+            {"_id": _oid(conversation_id)},
+            {"$set": {"updated_at": updated_at}}
+        )
+
+    def _ensure_bump_flusher(self):
+        # Gọi khi đang giữ _bump_lock
+        if self._bump_flusher is None:
+            self._bump_flusher = threading.Thread(target=self._flush_bumps_periodically, name="mongo-bump-flush", daemon=True)
+            self._bump_flusher.start()
+
+    def _flush_bumps_periodically(self):
+        """Write deferred updated_at values once per debounce window, so reads are
+        correct whichever worker serves get_user_conversations. Exits when idle."""
+        while True:
+            time.sleep(UPDATED_AT_DEBOUNCE_SEC)
+            self.flush_pending_bumps()
+            with self._bump_lock:
+                if not self._pending_bumps and not self._last_bump:
+                    self._bump_flusher = None
+                    return
+
+    def flush_pending_bumps(self):
+        """Write all debounced updated_at values in a single bulk_write"""
+        if self.db is None:
+            return
+
+        mono_now = time.monotonic()
+        with self._bump_lock:
+            pending = self._pending_bumps
+            self._pending_bumps = {}
+            for conversation_id in pending:
+                self._last_bump[conversation_id] = mono_now
+            # Bỏ các mốc đã quá hạn debounce để dict không phình ra mãi
+            self._last_bump = {
+                conv_id: ts for conv_id, ts in self._last_bump.items()
+                if mono_now - ts < UPDATED_AT_DEBOUNCE_SEC
+            }
+
+        if not pending:
+            return
+
+        try:
+            self.db['conversations'].bulk_write([
+                UpdateOne({"_id": _oid(conv_id)}, {"$set": {"updated_at": updated_at}})
+                for conv_id, updated_at in pending.items()
+            ], ordered=False)
+        except Exception as e:
+            log.error("❌ Error flushing conversation timestamps: %s", e)
+
     def update_conversation_title(self, conversation_id, new_title):
         """Update the title of a conversation"""
         if self.db is None:
@@ -156,94 +349,117 @@ class DatabaseManager:
         try:
             conv_col = self.db['conversations']
             conv_col.update_one(
-                {"_id": ObjectId(conversation_id)},
+                {"_id": _oid(conversation_id)},
                 {"$set": {"title": new_title}}
             )
             return True
         except Exception as e:
-            print(f"❌ Error updating title: {e}")
+            log.error("❌ Error updating title: %s", e)
             return False
 
     def get_conversation_messages(self, conversation_id, user_id):
         """Get all messages for a specific conversation"""
-        print(f"DEBUG_DB: get_conversation_messages called with conv_id={conversation_id}, user_id={user_id}")
+        log.debug("get_conversation_messages called with conv_id=%s, user_id=%s", conversation_id, user_id)
         if self.db is None:
-            print("DEBUG_DB: Database not connected")
+            log.debug("Database not connected")
             return []
             
         try:
             # Relaxed Check: Try to find conversation by ID first
             conv_col = self.db['conversations']
-            conv = conv_col.find_one({"_id": ObjectId(conversation_id)})
+            conv = conv_col.find_one({"_id": _oid(conversation_id)}, {"user_id": 1})
             
             if not conv:
-                print(f"DEBUG_DB: Conversation {conversation_id} NOT FOUND.")
+                log.debug("Conversation %s NOT FOUND.", conversation_id)
                 return []
             
             # Check ownership but don't block (for debugging/compatibility)
             if str(conv.get('user_id')) != str(user_id):
-                 print(f"DEBUG_DB: WARNING - User mismatch! Owner: {conv.get('user_id')}, Request: {user_id}")
+                 log.debug("WARNING - User mismatch! Owner: %s, Request: %s", conv.get('user_id'), user_id)
                  # Uncomment the next line to enforce strict security later
                  # return [] 
             
-            print("DEBUG_DB: Conversation found. Fetching messages...")
+            log.debug("Conversation found. Fetching messages...")
                 
             msg_col = self.db['messages']
-            cursor = msg_col.find({"conversation_id": conversation_id}).sort("timestamp", 1)
-            
-            messages = []
-            for doc in cursor:
-                try:
-                    ts = doc.get("timestamp")
-                    if isinstance(ts, datetime.datetime):
-                        ts_str = ts.isoformat()
-                    else:
-                        ts_str = str(ts)
-                        
-                    messages.append({
-                        "role": doc.get("role", "model"),
-                        "text": doc.get("content", ""), # Ensuring 'text' key is present
-                        "timestamp": ts_str
-                    })
-                except Exception as e:
-                    print(f"DEBUG_DB: Error parsing message doc: {e}")
-                    continue
-
-            print(f"DEBUG_DB: Returning {len(messages)} messages.")
+            # Mongo định dạng sẵn timestamp (ISO, UTC) -> không xử lý từng doc ở Python
+            cursor = msg_col.aggregate([
+                {"$match": {"conversation_id": conversation_id}},
+                {"$sort": {"timestamp": 1}},
+                {"$project": {
+                    "_id": 0,
+                    "role": {"$ifNull": ["$role", "model"]},
+                    "text": {"$ifNull": ["$content", ""]}, # Ensuring 'text' key is present
+                    "timestamp": {"$cond": [
+                        {"$eq": [{"$type": "$timestamp"}, "date"]},
+                        {"$dateToString": {"format": "%Y-%m-%dT%H:%M:%S.%LZ", "date": "$timestamp"}},
+                        {"$toString": "$timestamp"}
+                    ]}
+                }}
+            ])
+            messages = list(cursor)
+
+            log.debug("Returning %d messages.", len(messages))
             return messages
         except Exception as e:
-            print(f"❌ Error fetching messages: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("❌ Error fetching messages: %s", e)
             return []
 
     def get_messages(self, conversation_id, limit=50):
         """Get messages for a specific conversation"""
-        print(f"DEBUG_DB: get_messages called for ID: {conversation_id}")
+        log.debug("get_messages called for ID: %s", conversation_id)
         if self.db is None:
             return []
         
         try:
             collection = self.db['messages']
-            # Debug: Check if any message exists with this ID
-            count = collection.count_documents({"conversation_id": conversation_id})
-            print(f"DEBUG_DB: Found {count} messages for conv_id {conversation_id}")
             
-            cursor = collection.find({"conversation_id": conversation_id}).sort("timestamp", 1).limit(limit)
+            cursor = collection.find(
+                {"conversation_id": conversation_id},
+                {"role": 1, "content": 1, "_id": 0}
+            ).sort("timestamp", 1).limit(limit)
             
             messages = []
             for doc in cursor:
                 # Debug print for first doc
-                # if len(messages) == 0: print(f"DEBUG_DB: First doc: {doc}")
+                # if len(messages) == 0: log.debug("First doc: %s", doc)
                 messages.append({
                     "role": doc["role"],
                     "content": doc["content"]
                 })
             return messages
         except Exception as e:
-            print(f"❌ Error getting messages: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("❌ Error getting messages: %s", e)
+            return []
+
+    def owns_conversation(self, conversation_id, user_id):
+        """Check that the conversation exists and belongs to user_id"""
+        if self.db is None:
+            return False
+        try:
+            return self.db['conversations'].find_one(
+                {"_id": _oid(conversation_id), "user_id": user_id}, {"_id": 1}
+            ) is not None
+        except Exception as e: # conversation_id không phải ObjectId hợp lệ
+            log.debug("owns_conversation failed for %s: %s", conversation_id, e)
+            return False
+
+    def get_recent_messages(self, conversation_id, limit=MAX_HISTORY_TURNS):
+        """Get the latest `limit` messages of a conversation, oldest first (model context)"""
+        if self.db is None:
+            return []
+        
+        try:
+            # Sort giảm dần + limit để lấy các tin mới nhất (dùng index conversation_id/timestamp), rồi đảo lại
+            cursor = self.db['messages'].find(
+                {"conversation_id": conversation_id},
+                {"role": 1, "content": 1, "_id": 0}
+            ).sort("timestamp", -1).limit(limit)
+            messages = [{"role": doc["role"], "content": doc["content"]} for doc in cursor]
+            messages.reverse()
+            return messages
+        except Exception as e:
+            log.exception("❌ Error getting recent messages: %s", e)
             return []
 
     def register_user(self, username, password):
@@ -254,7 +470,7 @@ class DatabaseManager:
         users_col = self.db['users']
         
         # Check if user exists
-        if users_col.find_one({"username": username}):
+        if users_col.find_one({"username": username}, {"_id": 1}):
             return False, "Username already exists"
             
         # Hash password
@@ -263,7 +479,7 @@ class DatabaseManager:
         users_col.insert_one({
             "username": username,
             "password": password_hash,
-            "created_at": datetime.datetime.now()
+            "created_at": datetime.datetime.utcnow()
         })
         return True, "Registration successful"
 
@@ -271,12 +487,49 @@ class DatabaseManager:
         """Authenticate a user"""
         if self.db is None:
             return None
+        
+        digest = self._password_digest(password)
+        user_id = self._get_cached_login(username, digest)
+        if user_id:
+            return user_id
             
-        user = self.db['users'].find_one({"username": username})
+        user = self.db['users'].find_one({"username": username}, {"password": 1})
         if user and check_password_hash(user['password'], password):
-            return str(user['_id']) # Return User ID as string
+            user_id = str(user['_id']) # Return User ID as string
+            self._cache_login(username, digest, user_id)
+            return user_id
         return None
 
+    def _password_digest(self, password):
+        """Fast keyed digest used only for the in-memory login cache"""
+        return hmac.new(self._login_cache_key, (password or "").encode('utf-8'), hashlib.sha256).digest()
+
+    def _get_cached_login(self, username, digest):
+        with self._login_lock:
+            entry = self._login_cache.get(username)
+            if entry is None:
+                return None
+            cached_digest, user_id, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._login_cache[username]
+                return None
+            if not hmac.compare_digest(cached_digest, digest):
+                return None
+            self._login_cache.move_to_end(username)
+            return user_id
+
+    def _cache_login(self, username, digest, user_id):
+        with self._login_lock:
+            self._login_cache[username] = (digest, user_id, time.monotonic() + LOGIN_CACHE_TTL_SEC)
+            self._login_cache.move_to_end(username)
+            while len(self._login_cache) > LOGIN_CACHE_MAX_SIZE:
+                self._login_cache.popitem(last=False)
+
+    def _invalidate_login_cache(self, user_id):
+        with self._login_lock:
+            for username in [u for u, entry in self._login_cache.items() if entry[1] == user_id]:
+                del self._login_cache[username]
+
     def change_password(self, user_id, old_password, new_password):
         """Change user password after verifying the old one"""
         if self.db is None:
@@ -284,7 +537,7 @@ class DatabaseManager:
             
         try:
             users_col = self.db['users']
-            user = users_col.find_one({"_id": ObjectId(user_id)})
+            user = users_col.find_one({"_id": _oid(user_id)}, {"password": 1})
             
             if not user:
                 return False, "User not found"
@@ -296,10 +549,11 @@ class DatabaseManager:
             # Update to new password
             new_password_hash = generate_password_hash(new_password)
             users_col.update_one(
-                {"_id": ObjectId(user_id)},
+                {"_id": _oid(user_id)},
                 {"$set": {"password": new_password_hash}}
             )
+            self._invalidate_login_cache(str(user_id))
             return True, "Đổi mật khẩu thành công"
         except Exception as e:
-            print(f"❌ Error changing password: {e}")
+            log.error("❌ Error changing password: %s", e)
             return False, str(e)
@@ -11,9 +11,74 @@ Chức năng chính:
 
 import asyncio
 import base64
-import json
+import logging
+import re
+from collections import deque
+from typing import AsyncIterator
+from contextlib import asynccontextmanager
+from functools import lru_cache
+import orjson
 import websockets
-from db_utils import DatabaseManager
+from websockets.exceptions import ConnectionClosed
+from websockets.protocol import State
+from db_utils import DatabaseManager, recent_history
+
+# Logger con của "chatbot" (mức log cấu hình qua LOGLEVEL ở app.py)
+log = logging.getLogger('chatbot.voice')
+
+# 0.3s im lặng (\x00) chèn vào đầu audio để tránh Chrome bị mất tiếng lúc bắt đầu (Hardware lag)
+# 24000 samples/s * 0.3s * 2 bytes = 14400 bytes
+_SILENCE_PAD_300MS = b'\x00' * 14400
+
+# Regex lọc các header dạng **Header** (suy nghĩ nội bộ của model) khỏi text trả về
+_HEADER_RE = re.compile(r'\*\*.*?\*\*')
+
+# Cắt header WAV trực tiếp trên chuỗi base64 (không decode + encode lại cả file).
+# Base64 mã hoá theo nhóm 3 bytes -> 4 ký tự; 44 bytes header không chia hết cho 3,
+# nên cắt 56 ký tự = 42 bytes. 2 bytes còn lại (nửa cao của data_size) thành
+# 1 sample đầu tiên gần như bằng 0 -> không nghe thấy, và PCM 16-bit vẫn đúng căn lề.
+_RIFF_B64_PREFIX = 'UklGR' # base64 của b'RIFF'
+_WAV_HEADER_B64_CHARS = 56
+
+_TTS_SYSTEM_TEXT = "You are a helpful reading assistant. Read the provided text clearly and naturally."
+_CHAT_SYSTEM_TEXT = "You are a helpful voice assistant. Listen to the user's audio or read their text, transcribe/process it, and respond naturally in {language}. DO NOT output your internal thoughts, reasoning, or headers. ONLY output the final spoken response."
+
+@lru_cache(maxsize=256)
+def _setup_payload(model: str, system_text: str, voice: str, transcribe_input: bool = False) -> bytes:
+    """
+    Setup message (đã serialize) cho Gemini Live API.
+    Chỉ phụ thuộc model / system instruction / voice -> build + orjson.dumps 1 lần cho mỗi cấu hình.
+    transcribe_input: yêu cầu Gemini trả transcript audio của user (để lưu lịch sử voice).
+    """
+    # Gemini Multimodal Live API (WebSocket) 
+    # Dùng camelCase cho protocol WebSocket v1beta
+    setup = {
+        "model": f"models/{model}",
+        "systemInstruction": {
+            "parts": [{"text": system_text}]
+        },
+        "generationConfig": {
+            "responseModalities": ["AUDIO"],
+            "speechConfig": {
+                "voiceConfig": {
+                    "prebuiltVoiceConfig": {"voiceName": voice}
+                }
+            }
+        }
+    }
+    if transcribe_input:
+        setup["inputAudioTranscription"] = {}
+    return orjson.dumps({"setup": setup})
+
+# Pool các WebSocket session đã setup sẵn. Chỉ pool các cấu hình được đăng ký qua warmup()
+# (voice/language đến từ client -> không để client tự tạo pool mới)
+WS_POOL_SIZE = 2
+# Tổng số session idle của mọi cấu hình (tính cả session đang mở nền) - giới hạn quota Live API
+WS_POOL_MAX_IDLE = 4
+# Session để lâu trong pool có thể đã bị Gemini đóng -> bỏ và mở lại
+WS_POOL_MAX_AGE_SEC = 300.0
+# Chu kỳ dọn session hết hạn / đã đóng trong pool
+WS_POOL_REAP_INTERVAL_SEC = 60.0
 
 class VoiceChatService:
     def __init__(self, api_key: str):
@@ -25,259 +90,405 @@ class VoiceChatService:
         
         # Kết nối DB (dự phòng, hiện tại Voice chưa lưu history nhưng có sẵn để dùng)
         self.db_manager = DatabaseManager()
+        
+        # Pool session: key cấu hình -> deque[(ws, opened_at)], chỉ chứa key đã warmup
+        # Chỉ dùng trên event loop chạy voice (app.config['AIO_LOOP'])
+        self._ws_pools = {}
+        self._ws_pool_payloads = {} # key -> setup payload (để mở bù khi dọn pool)
+        self._ws_pool_pending = {} # key -> số session đang được mở nền
+        self._ws_pool_tasks = set()
+        self._ws_pool_reaper = None
 
-    async def text_to_speech(self, text: str, voice: str = "Puck") -> bytes:
-        """
-        Chuyển đổi Text thành Audio (TTS).
-        Sử dụng WebSocket để gửi text và nhận về các chunk audio PCM.
-        """
-        audio_chunks = []
+    async def _open_session(self, setup_payload: bytes):
+        """Mở WebSocket mới và hoàn tất bước setup với Gemini."""
+        ws = await websockets.connect(self.ws_url)
         try:
-            async with websockets.connect(self.ws_url) as ws:
-                # 1. Gửi tin nhắn Setup (cấu hình voice)
-                setup_message = {
-                    "setup": {
-                        "model": f"models/{self.model}",
-                        "systemInstruction": {
-                            "parts": [{"text": "You are a helpful reading assistant. Read the provided text clearly and naturally."}]
-                        },
-                        "generationConfig": {
-                            "responseModalities": ["AUDIO"],
-                            "speechConfig": {
-                                "voiceConfig": {
-                                    "prebuiltVoiceConfig": {
-                                        "voiceName": voice
-                                    }
-                                }
-                            }
-                        }
-                    }
-                }
-                
-                await ws.send(json.dumps(setup_message))
-                setup_resp = await ws.recv() # Đợi xác nhận setup
-                print(f"✅ TTS Setup Response: {setup_resp}")
-                
-                # 2. Gửi yêu cầu đọc văn bản
-                prompt_message = {
-                    "clientContent": {
-                        "turns": [{
-                            "role": "user",
-                            "parts": [{"text": f"Please read this text aloud: {text}"}]
-                        }],
-                        "turnComplete": True
-                    }
-                }
-                
-                await ws.send(json.dumps(prompt_message))
-                
-                # 3. Nhận phản hồi
-                while True:
-                    try:
-                        response = await asyncio.wait_for(ws.recv(), timeout=10.0)
-                        data = json.loads(response)
-                        
-                        if "serverContent" in data:
-                            server_content = data["serverContent"]
-                            if "modelTurn" in server_content:
-                                parts = server_content["modelTurn"].get("parts", [])
-                                for part in parts:
-                                    if "inlineData" in part: # Audio data
-                                        audio_b64 = part["inlineData"]["data"]
-                                        audio_chunks.append(base64.b64decode(audio_b64))
-                            if server_content.get("turnComplete", False):
-                                break
-                    except asyncio.TimeoutError:
-                        break
-                    except Exception:
-                        break
-        except Exception as e:
-            print(f"TTS WebSocket error: {e}")
+            await ws.send(setup_payload, text=True)
+            try:
+                setup_confirm_raw = await asyncio.wait_for(ws.recv(), timeout=10.0)
+            except asyncio.TimeoutError:
+                log.error("🛑 Setup Timeout: Gemini did not respond to setup message.")
+                raise Exception("Gemini Setup Timeout")
+            
+            setup_confirm = orjson.loads(setup_confirm_raw)
+            log.debug("✅ Setup Response: %s", setup_confirm_raw)
+            if "setupComplete" not in setup_confirm:
+                log.error("🛑 Gemini Setup Failed! Response: %s", setup_confirm_raw)
+                raise Exception("Gemini Setup Failed")
+        except BaseException:
+            self._spawn(ws.close())
             raise
-        
-        return b''.join(audio_chunks)
-    async def chat_with_voice(self, message: str, voice: str = "Puck", conversation_history: list = None, language: str = "vi", audio_input: str = None, mime_type: str = "audio/wav") -> dict:
+        return ws
+
+    async def _acquire(self, key: tuple, setup_payload: bytes):
         """
-        Chat Voice 2 chiều.
-        Input: Tin nhắn text của User.
-        Output: Audio giọng nói của AI + Text phản hồi.
+        Lấy 1 session đã setup sẵn từ pool (bỏ qua TLS handshake + setup round-trip).
+        Session đã đóng hoặc quá cũ sẽ bị bỏ; pool hết (hoặc cấu hình không được pool) thì mở session mới.
+        Trả về (ws, pooled): pooled=True nếu session lấy từ pool.
         """
-        audio_chunks = []
-        response_text = ""
+        pool = self._ws_pools.get(key)
+        if pool is None:
+            return await self._open_session(setup_payload), False
         
+        now = asyncio.get_running_loop().time()
+        ws = None
+        while pool:
+            candidate, opened_at = pool.popleft()
+            if self._is_fresh(candidate, opened_at, now):
+                ws = candidate
+                break
+            self._spawn(candidate.close())
+        
+        # Mở bù session cho request sau (chạy nền)
+        self._refill(key)
+        
+        if ws is None:
+            return await self._open_session(setup_payload), False
+        return ws, True
+
+    @staticmethod
+    def _is_fresh(ws, opened_at: float, now: float) -> bool:
+        return ws.state is State.OPEN and now - opened_at < WS_POOL_MAX_AGE_SEC
+
+    async def _release(self, ws):
+        """
+        Session Gemini Live giữ context hội thoại của request vừa xong,
+        nên không trả lại pool (tránh lộ context sang request khác) mà đóng nền.
+        """
+        self._spawn(ws.close())
+
+    @asynccontextmanager
+    async def _turn(self, key: tuple, setup_payload: bytes, prompt: bytes, timeout: float):
+        """
+        Gửi 1 turn và chờ frame phản hồi đầu tiên, yield (ws, frame đầu).
+        Session trong pool có thể đã bị Gemini đóng mà state vẫn là OPEN -> ConnectionClosed
+        ở lần send/recv đầu: bỏ session đó và chạy lại turn 1 lần trên session mới.
+        """
+        ws, pooled = await self._acquire(key, setup_payload)
         try:
-            async with websockets.connect(self.ws_url) as ws:
-                # 1. Setup session
-                # Gemini Multimodal Live API (WebSocket) 
-                # Dùng camelCase cho protocol WebSocket v1beta
-                setup_message = {
-                    "setup": {
-                        "model": f"models/{self.model}",
-                        "systemInstruction": { 
-                            "parts": [{"text": f"You are a helpful voice assistant. Listen to the user's audio or read their text, transcribe/process it, and respond naturally in {language}. DO NOT output your internal thoughts, reasoning, or headers. ONLY output the final spoken response."}]
-                        },
-                        "generationConfig": { 
-                            "responseModalities": ["AUDIO"], 
-                            "speechConfig": {
-                                "voiceConfig": {
-                                    "prebuiltVoiceConfig": {"voiceName": voice}
-                                }
-                            }
-                        }
-                    }
-                }
-                
-                await ws.send(json.dumps(setup_message))
-                try:
-                    setup_confirm_raw = await asyncio.wait_for(ws.recv(), timeout=10.0)
-                    setup_confirm = json.loads(setup_confirm_raw)
-                    print(f"✅ Voice Chat Setup Response: {setup_confirm_raw}", flush=True)
-                    
-                    if "setupComplete" not in setup_confirm:
-                        print(f"🛑 Gemini Setup Failed! Response: {setup_confirm_raw}", flush=True)
-                except asyncio.TimeoutError:
-                    print("🛑 Setup Timeout: Gemini did not respond to setup message.", flush=True)
-                    raise Exception("Gemini Setup Timeout")
-                
-                # 2. Xây dựng hội thoại (History + Current)
-                turns = []
-                
-                # Thêm lịch sử (nếu có)
-                if conversation_history:
-                    print(f"📚 Found {len(conversation_history)} messages in history", flush=True)
-                    for i, msg in enumerate(conversation_history):
-                        role = "user" if msg.get('role') == 'user' else "model"
-                        
-                        # Hỗ trợ cả cấu trúc Gemini (parts) và cấu trúc phẳng (text/content)
-                        content = ""
-                        if 'parts' in msg and isinstance(msg['parts'], list) and len(msg['parts']) > 0:
-                            content = msg['parts'][0].get('text', '')
-                        else:
-                            content = msg.get('text') or msg.get('content') or ""
-                        
-                        if content:
-                            print(f"  - Turn {i}: [{role}] {content[:50]}...", flush=True)
-                            turns.append({
-                                "role": role,
-                                "parts": [{"text": content}]
-                            })
-                
-                # 3. Thêm tin nhắn hiện tại (Hỗ trợ cả MESSAGE TEXT và AUDIO)
-                current_parts = []
-                
-                if message:
-                    print(f"💬 Text input detected: {message}", flush=True)
-                    current_parts.append({"text": message})
-                
-                if audio_input:
-                    # Log định dạng gốc để debug
-                    print(f"DEBUG: Original Mime: {mime_type}", flush=True)
-                    audio_bytes_raw = base64.b64decode(audio_input)
-                    audio_bytes_len = len(audio_bytes_raw)
-                    print(f"📥 Input Audio Size: {audio_bytes_len} bytes", flush=True)
-                    
-                    final_mime = "audio/webm;codecs=opus" if "webm" in mime_type.lower() else "audio/l16;rate=24000"
-                    processed_audio = audio_input
-                    
-                    if "wav" in final_mime.lower() or "l16" in final_mime.lower():
-                        if audio_bytes_raw.startswith(b'RIFF'):
-                            print("✂️ [WAV] Detected RIFF header. Stripping 44 bytes...", flush=True)
-                            audio_bytes_stripped = audio_bytes_raw[44:]
-                            processed_audio = base64.b64encode(audio_bytes_stripped).decode('utf-8')
+            try:
+                first_frame = await self._send_turn(ws, prompt, timeout)
+            except ConnectionClosed as e:
+                if not pooled:
+                    raise
+                log.warning("♻️ Pooled Gemini session was closed (%s), retrying on a new session", e)
+                await self._release(ws)
+                ws = await self._open_session(setup_payload)
+                first_frame = await self._send_turn(ws, prompt, timeout)
+            yield ws, first_frame
+        finally:
+            await self._release(ws)
 
-                    print(f"🎤 Sending Audio to Gemini with MIME: {final_mime}", flush=True)
-                    current_parts.append({
-                        "inlineData": { 
-                            "mimeType": final_mime,
-                            "data": processed_audio
-                        }
-                    })
-                
-                if not current_parts:
-                    raise Exception("No input provided (neither text nor audio)")
+    @staticmethod
+    async def _send_turn(ws, prompt: bytes, timeout: float):
+        await ws.send(prompt, text=True)
+        try:
+            return await asyncio.wait_for(ws.recv(), timeout=timeout)
+        except asyncio.TimeoutError:
+            # Không có frame nào -> lỗi, không trả về reply rỗng
+            raise Exception("Gemini Response Timeout")
 
-                turns.append({
-                    "role": "user",
-                    "parts": current_parts
-                })
+    @staticmethod
+    async def _frames(ws, first_frame, timeout: float):
+        """
+        Các frame (đã decode) của 1 turn: frame đầu rồi tới các frame nhận tiếp.
+        Timeout / lỗi sau frame đầu thì dừng, giữ phần đã nhận.
+        """
+        raw = first_frame
+        while True:
+            yield orjson.loads(raw)
+            try:
+                raw = await asyncio.wait_for(ws.recv(), timeout=timeout)
+            except asyncio.TimeoutError:
+                log.warning("⏱️ WebSocket timeout")
+                return
+            except Exception as e:
+                log.error("❌ WebSocket receive error: %s", e)
+                return
 
-                if len(turns) > 1:
-                    print(f"🔄 Total turns being sent: {len(turns)}", flush=True)
+    def _refill(self, key: tuple):
+        idle_total = sum(map(len, self._ws_pools.values())) + sum(self._ws_pool_pending.values())
+        missing = min(
+            WS_POOL_SIZE - len(self._ws_pools[key]) - self._ws_pool_pending.get(key, 0),
+            WS_POOL_MAX_IDLE - idle_total
+        )
+        for _ in range(missing):
+            self._ws_pool_pending[key] = self._ws_pool_pending.get(key, 0) + 1
+            self._spawn(self._add_to_pool(key))
 
-                # --- FINAL TURNS ---
-                final_turns = turns
-                
-                # 4. Gửi toàn bộ nội dung
-                prompt_input = {
-                    "clientContent": {
-                        "turns": final_turns,
-                        "turnComplete": True
-                    }
-                }
-                
-                print(f"DEBUG: Prompt Request: {json.dumps(prompt_input)[:200]}...")
-                await ws.send(json.dumps(prompt_input))
-                
-                # 5. Nhận phản hồi (Audio + Text)
-                print("⏳ Waiting for Gemini response...")
-                while True:
-                    try:
-                        response = await asyncio.wait_for(ws.recv(), timeout=15.0)
-                        data = json.loads(response)
-                        
-                        # Debug: Log response structure
-                        # print(f"📡 WebSocket Response: {data}") # TOO NOISY
-                        
-                        if "serverContent" in data:
-                            server_content = data["serverContent"]
-                            if "modelTurn" in server_content:
-                                parts = server_content["modelTurn"].get("parts", [])
-                                print(f"📦 Received {len(parts)} parts from Gemini")
-                                for part in parts:
-                                    if "text" in part: # Nhận Text
-                                        response_text += part["text"]
-                                        print(f"📝 Text part: {part['text'][:100]}...")
-                                    if "inlineData" in part: # Nhận Audio chunks
-                                        audio_b64 = part["inlineData"]["data"]
-                                        audio_chunks.append(base64.b64decode(audio_b64))
-                                        print(f"🔊 Audio chunk: {len(audio_b64)} bytes (base64)")
-                        if server_content.get("turnComplete", False):
-                                print("DEBUG: Turn Complete received")
-                                break
-                        else:
-                            print(f"⚠️ Unexpected response keys: {data.keys()}")
-                            if "error" in data:
-                                print(f"🛑 Gemini Error Data: {json.dumps(data['error'])}")
-                    except asyncio.TimeoutError:
-                        print("⏱️ WebSocket timeout")
-                        break
-                    except Exception as e:
-                        print(f"❌ WebSocket receive error: {e}")
+    async def _add_to_pool(self, key: tuple):
+        try:
+            ws = await self._open_session(self._ws_pool_payloads[key])
+            self._ws_pools[key].append((ws, asyncio.get_running_loop().time()))
+        except Exception as e:
+            log.warning("⚠️ Could not pre-open Gemini session: %s", e)
+        finally:
+            self._ws_pool_pending[key] -= 1
+
+    async def _reap_pools(self):
+        """Định kỳ đóng session hết hạn / đã bị Gemini đóng và mở bù (không chờ tới lần acquire sau)."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(WS_POOL_REAP_INTERVAL_SEC)
+            now = loop.time()
+            for pool in self._ws_pools.values():
+                for _ in range(len(pool)):
+                    ws, opened_at = pool.popleft()
+                    if self._is_fresh(ws, opened_at, now):
+                        pool.append((ws, opened_at))
+                    else:
+                        self._spawn(ws.close())
+            for key in self._ws_pools:
+                self._refill(key)
+
+    def _spawn(self, coro):
+        # Giữ reference tới task nền để không bị GC giữa chừng
+        task = asyncio.get_running_loop().create_task(coro)
+        self._ws_pool_tasks.add(task)
+        task.add_done_callback(self._ws_pool_tasks.discard)
+
+    async def warmup(self, voice: str = "Charon", language: str = "vi"):
+        """
+        Đăng ký cấu hình voice chat được pool và mở sẵn session ngay lúc khởi động,
+        để request đầu tiên không phải chờ TLS handshake + setup.
+        """
+        key = ("chat", voice, language)
+        self._ws_pool_payloads[key] = _setup_payload(self.model, _CHAT_SYSTEM_TEXT.format(language=language), voice, transcribe_input=True)
+        self._ws_pools.setdefault(key, deque())
+        self._refill(key)
+        if self._ws_pool_reaper is None:
+            # Giữ reference riêng: task dọn pool chạy suốt vòng đời service
+            self._ws_pool_reaper = asyncio.get_running_loop().create_task(self._reap_pools())
+
+    async def text_to_speech(self, text: str, voice: str = "Puck") -> bytes:
+        """
+        Chuyển đổi Text thành Audio (TTS), trả về toàn bộ PCM.
+        Dùng stream_text_to_speech nếu muốn phát audio ngay khi có chunk đầu tiên.
+        """
+        return b''.join([chunk async for chunk in self.stream_text_to_speech(text, voice)])
+
+    async def stream_text_to_speech(self, text: str, voice: str = "Puck") -> AsyncIterator[bytes]:
+        """
+        Chuyển đổi Text thành Audio (TTS) dạng stream.
+        Sử dụng WebSocket để gửi text và yield từng chunk audio PCM ngay khi nhận được.
+        """
+        _b64d = base64.b64decode
+        # 1. Tin nhắn Setup (cấu hình voice)
+        setup_payload = _setup_payload(self.model, _TTS_SYSTEM_TEXT, voice)
+        # 2. Yêu cầu đọc văn bản
+        prompt_message = {
+            "clientContent": {
+                "turns": [{
+                    "role": "user",
+                    "parts": [{"text": f"Please read this text aloud: {text}"}]
+                }],
+                "turnComplete": True
+            }
+        }
+        try:
+            # Session lấy từ pool đã setup xong
+            async with self._turn(("tts", voice), setup_payload, orjson.dumps(prompt_message), timeout=10.0) as (ws, first_frame):
+                # 3. Nhận phản hồi
+                async for data in self._frames(ws, first_frame, timeout=10.0):
+                    # 1 lượt duyệt dict: serverContent -> modelTurn -> parts
+                    server_content = data.get("serverContent")
+                    if server_content is None:
+                        continue
+                    model_turn = server_content.get("modelTurn")
+                    if model_turn is not None:
+                        for part in model_turn.get("parts", ()):
+                            inline_data = part.get("inlineData")
+                            if inline_data is not None: # Audio data
+                                yield _b64d(inline_data["data"])
+                    if server_content.get("turnComplete", False):
                         break
-                        
         except Exception as e:
-            import traceback
-            print(f"Voice Chat WebSocket error: {e}")
-            print(traceback.format_exc())
+            log.error("TTS WebSocket error: %s", e)
             raise
-            
-        # 6. Chuẩn bị kết quả
-        # Thêm 0.3s im lặng (\x00) vào đầu để tránh Chrome bị mất tiếng lúc bắt đầu (Hardware lag)
-        # 24000 samples/s * 0.3s * 2 bytes = 14400 bytes
-        silence_padding = b'\x00' * int(24000 * 0.3 * 2)
-        raw_audio = silence_padding + b''.join(audio_chunks)
+
+    async def chat_with_voice(self, message: str, voice: str = "Puck", conversation_history: list = None, language: str = "vi", audio_input: str = None, mime_type: str = "audio/wav", audio_bytes: bytes = None) -> dict:
+        """
+        Chat Voice 2 chiều.
+        Input: Tin nhắn text của User, audio base64 (audio_input) hoặc audio nhị phân (audio_bytes).
+        Output: Audio giọng nói của AI + Text phản hồi (đã gom đủ cả turn).
+        """
+        # Thêm 0.3s im lặng ở đầu, ghép cùng các chunk trong 1 lần join
+        audio_chunks = [_SILENCE_PAD_300MS]
+        text_parts = []
+        transcript_parts = []
+        async for event in self.stream_chat_with_voice(message, voice, conversation_history, language, audio_input, mime_type, audio_bytes=audio_bytes):
+            if "audio" in event:
+                audio_chunks.append(event["audio"])
+            elif "text" in event:
+                text_parts.append(event["text"])
+            else:
+                transcript_parts.append(event["transcript"])
+        
+        if len(audio_chunks) == 1 and not text_parts:
+            # Kết nối đứt trước khi có nội dung -> báo lỗi thay vì trả về reply chỉ có tiếng im lặng
+            raise Exception("Gemini returned an empty response")
+        
+        raw_audio = b''.join(audio_chunks)
+        response_text = ''.join(text_parts)
         total_audio_len = len(raw_audio)
         
         # Estimate duration: Gemini output is usually 24kHz, 16-bit PCM mono
         duration_sec = total_audio_len / (24000 * 2) 
-        print(f"🎤 AI Response: {len(response_text)} chars, {total_audio_len} bytes (~{duration_sec:.2f}s, included 0.3s padding)")
+        log.info("🎤 AI Response: %d chars, %d bytes (~%.2fs, included 0.3s padding)", len(response_text), total_audio_len, duration_sec)
         
         # Filter out thoughts/headers (lines starting with ** or similar)
-        import re
-        clean_text = re.sub(r'\*\*.*?\*\*', '', response_text).strip() # Remove **Header**
+        clean_text = _HEADER_RE.sub('', response_text).strip() # Remove **Header**
         # Remove lines that look like reasoning if mixed (simple heuristic)
         
         return {
             "text": clean_text if clean_text else response_text.strip(),
-            "audio": raw_audio
+            "audio": raw_audio,
+            "transcript": ''.join(transcript_parts).strip() # Lời user (nếu input là audio)
         }
+
+    async def stream_chat_with_voice(self, message: str, voice: str = "Puck", conversation_history: list = None, language: str = "vi", audio_input: str = None, mime_type: str = "audio/wav", audio_bytes: bytes = None) -> AsyncIterator[dict]:
+        """
+        Chat Voice 2 chiều dạng stream.
+        Yield từng event ngay khi nhận từ Gemini: {"text": str}, {"audio": bytes (PCM)}
+        hoặc {"transcript": str} (transcript audio của user).
+        Text chưa được lọc header, audio chưa có silence padding (xem chat_with_voice).
+        """
+        _b64d = base64.b64decode
+        
+        # 1. Setup session
+        setup_payload = _setup_payload(self.model, _CHAT_SYSTEM_TEXT.format(language=language), voice, transcribe_input=True)
+        
+        # 2. Xây dựng hội thoại (History + Current)
+        turns = []
+        
+        # Thêm lịch sử (nếu có)
+        if conversation_history:
+            log.debug("📚 Found %d messages in history", len(conversation_history))
+            for i, msg in enumerate(recent_history(conversation_history)):
+                role = "user" if msg.get('role') == 'user' else "model"
+                
+                # Hỗ trợ cả cấu trúc Gemini (parts) và cấu trúc phẳng (text/content)
+                content = ""
+                if 'parts' in msg and isinstance(msg['parts'], list) and len(msg['parts']) > 0:
+                    content = msg['parts'][0].get('text', '')
+                else:
+                    content = msg.get('text') or msg.get('content') or ""
+                
+                if content:
+                    log.debug("  - Turn %d: [%s] %.50s...", i, role, content)
+                    turns.append({
+                        "role": role,
+                        "parts": [{"text": content}]
+                    })
+        
+        # 3. Thêm tin nhắn hiện tại (Hỗ trợ cả MESSAGE TEXT và AUDIO)
+        current_parts = []
+        
+        if message:
+            log.debug("💬 Text input detected: %s", message)
+            current_parts.append({"text": message})
+        
+        if audio_input or audio_bytes:
+            # Log định dạng gốc để debug
+            log.debug("Original Mime: %s", mime_type)
+            # Không decode/encode lại base64: kích thước tính từ độ dài chuỗi
+            if audio_bytes is not None:
+                audio_bytes_len = len(audio_bytes)
+            else:
+                audio_bytes_len = len(audio_input) * 3 // 4 - audio_input.count('=', -2)
+            log.debug("📥 Input Audio Size: %d bytes", audio_bytes_len)
+            
+            final_mime = "audio/webm;codecs=opus" if "webm" in mime_type.lower() else "audio/l16;rate=24000"
+            processed_audio = audio_input
+            
+            if "wav" in final_mime.lower() or "l16" in final_mime.lower():
+                if audio_bytes is not None:
+                    if audio_bytes.startswith(b'RIFF'):
+                        log.debug("✂️ [WAV] Detected RIFF header. Stripping 44 bytes...")
+                        processed_audio = base64.b64encode(audio_bytes[44:]).decode('utf-8')
+                elif audio_input.startswith(_RIFF_B64_PREFIX):
+                    log.debug("✂️ [WAV] Detected RIFF header. Stripping header on base64 string...")
+                    processed_audio = audio_input[_WAV_HEADER_B64_CHARS:]
+            
+            if processed_audio is None:
+                # Chỉ encode base64 1 lần (Gemini nhận inlineData dạng base64)
+                processed_audio = base64.b64encode(audio_bytes).decode('utf-8')
+
+            log.debug("🎤 Sending Audio to Gemini with MIME: %s", final_mime)
+            current_parts.append({
+                "inlineData": { 
+                    "mimeType": final_mime,
+                    "data": processed_audio
+                }
+            })
+        
+        if not current_parts:
+            raise Exception("No input provided (neither text nor audio)")
+
+        turns.append({
+            "role": "user",
+            "parts": current_parts
+        })
+
+        if len(turns) > 1:
+            log.debug("🔄 Total turns being sent: %d", len(turns))
+
+        # --- FINAL TURNS ---
+        final_turns = turns
+        
+        # 4. Gửi toàn bộ nội dung
+        prompt_input = {
+            "clientContent": {
+                "turns": final_turns,
+                "turnComplete": True
+            }
+        }
+        
+        # Không serialize cả payload (có thể chứa audio base64 vài MB) chỉ để log,
+        # chỉ log số turn / số part
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Prompt Request: %d turns, %d parts", len(final_turns), sum(len(t['parts']) for t in final_turns))
+        
+        try:
+            # Session lấy từ pool đã setup xong
+            async with self._turn(("chat", voice, language), setup_payload, orjson.dumps(prompt_input), timeout=15.0) as (ws, first_frame):
+                # 5. Nhận phản hồi (Audio + Text)
+                log.debug("⏳ Waiting for Gemini response...")
+                async for data in self._frames(ws, first_frame, timeout=15.0):
+                    # Debug: Log response structure
+                    # log.debug("📡 WebSocket Response: %s", data) # TOO NOISY
+                    
+                    # 1 lượt duyệt dict: serverContent -> modelTurn -> parts
+                    server_content = data.get("serverContent")
+                    if server_content is None:
+                        log.warning("⚠️ Unexpected response keys: %s", list(data))
+                        error = data.get("error")
+                        if error is not None:
+                            log.error("🛑 Gemini Error Data: %s", error)
+                        continue
+                    
+                    input_transcription = server_content.get("inputTranscription")
+                    if input_transcription is not None and input_transcription.get("text"):
+                        yield {"transcript": input_transcription["text"]}
+                    
+                    model_turn = server_content.get("modelTurn")
+                    if model_turn is not None:
+                        parts = model_turn.get("parts", ())
+                        log.debug("📦 Received %d parts from Gemini", len(parts))
+                        for part in parts:
+                            text = part.get("text")
+                            if text is not None: # Nhận Text
+                                log.debug("📝 Text part: %.100s...", text)
+                                yield {"text": text}
+                            inline_data = part.get("inlineData")
+                            if inline_data is not None: # Nhận Audio chunks
+                                audio_b64 = inline_data["data"]
+                                log.debug("🔊 Audio chunk: %d bytes (base64)", len(audio_b64))
+                                yield {"audio": _b64d(audio_b64)}
+                    if server_content.get("turnComplete", False):
+                        log.debug("Turn Complete received")
+                        break
+                        
+        except Exception as e:
+            log.exception("Voice Chat WebSocket error: %s", e)
+            raise
@@ -0,0 +1,14 @@
+# Monkey-patch gevent trước khi import bất kỳ thứ gì khác (socket, ssl, threading...)
+from gevent import monkey
+monkey.patch_all()
+
+# google-generativeai gọi Gemma qua gRPC: gRPC dùng I/O riêng (C-core), không bị monkey-patch,
+# nên phải bật chế độ gevent của gRPC, nếu không mỗi lần gọi LLM sẽ chặn cả worker.
+import grpc.experimental.gevent as grpc_gevent
+grpc_gevent.init_gevent()
+
+from app import app as application
+
+# Production entry point cho gunicorn (gevent worker):
+#   gunicorn -k gevent -w 2 --worker-connections 1000 wsgi:application
+# Mỗi worker xử lý nhiều request đồng thời trong khi chờ Gemini / MongoDB.